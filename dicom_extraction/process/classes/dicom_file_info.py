@@ -10,3 +10,4 @@ class DicomFileInfo:
     study_folder: str
     anon_dicom_id: str
     filename: str
+    png_name: str
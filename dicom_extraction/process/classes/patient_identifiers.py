@@ -1,8 +1,7 @@
-from dataclasses import dataclass
+from typing import TypedDict
 
 
-@dataclass
-class PatientIdentifiers:
+class PatientIdentifiers(TypedDict):
     """
     Note: The Dicom ID Heirarchy is:
     Patient ID
@@ -4,4 +4,11 @@ NEW_DATA_DIR_NAME = "deidentified_data"
 NEW_IMAGE_DIR_NAME = "images"
 GENERATED_DICOM_POSTFIX = "-generated_dicom.dcm"
 MAX_PATIENT_INDEX = 500
-MAX_STUDY_INDEX = 2
\ No newline at end of file
+MAX_STUDY_INDEX = 2
+
+# Number of dicom files handed to each worker process at a time
+PROCESS_POOL_CHUNKSIZE = 16
+
+# zlib level for the generated PNGs. Level 1 encodes several times faster
+# than the usual default of 6 for slightly larger, still lossless, files
+PNG_COMPRESS_LEVEL = 1
@@ -1,12 +1,16 @@
 # Standard library
 import ast
+import csv
+import functools
 import logging
-from typing import Tuple, Union
+import mmap
+import os
+from typing import BinaryIO, List, Optional, Tuple, Union
 
 # Third-party
 import numpy as np
-import pandas as pd
 import pydicom
+from pydicom.dataelem import DataElement, RawDataElement
 from pydicom.dataset import FileDataset, FileMetaDataset
 from pydicom.dicomdir import DicomDir
 from pydicom.uid import UID
@@ -15,45 +19,200 @@ from pydicom.uid import UID
 from .helpers import dicom_helper
 from .classes import PatientIdentifiers
 
-MINIMAL_TAGS_CSV_PATH = "dicom_extraction/dicom_tags/minimal_tags.csv"
-ADDITIONAL_TAGS_CSV_PATH = "dicom_extraction/dicom_tags/additional_tags.csv"
-TAGS_TO_MODIFY_CSV_PATH = "dicom_extraction/dicom_tags/tags_to_modify.csv"
+# The tag lists live next to the package, so that they are found whichever
+# directory the tool is run from
+DICOM_TAGS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dicom_tags"
+)
+MINIMAL_TAGS_CSV_PATH = os.path.join(DICOM_TAGS_DIR, "minimal_tags.csv")
+ADDITIONAL_TAGS_CSV_PATH = os.path.join(DICOM_TAGS_DIR, "additional_tags.csv")
+TAGS_TO_MODIFY_CSV_PATH = os.path.join(DICOM_TAGS_DIR, "tags_to_modify.csv")
 FILEMETA_KEYWORDS = [
     "FileMetaInformationGroupLength",
     "FileMetaInformationVersion",
     "TransferSyntaxUID",
 ]
+HEADER_METADATA_KEYWORDS = FILEMETA_KEYWORDS + [
+    "is_implicit_VR",
+    "is_little_endian",
+]
+SPECIAL_METADATA_KEYWORDS = ["day_of_week", "year", "hour_of_the_day", "age"]
+# Keywords whose values may be saved as Python literals in the metadata CSV
+LITERAL_KEYWORDS = frozenset(
+    [
+        "PixelSpacing",
+        "PixelAspectRatio",
+        "ImagerPixelSpacing",
+        "WindowCenter",
+        "WindowWidth",
+    ]
+)
+# Keywords whose values need to be cast before being set in a new dicom
+INT_KEYWORDS = frozenset(
+    [
+        "CollimatorRightVerticalEdge",
+        "CollimatorUpperHorizontalEdge",
+        "CollimatorLowerHorizontalEdge",
+        "LargestImagePixelValue",
+        "SmallestImagePixelValue",
+    ]
+)
+STR_KEYWORDS = frozenset(["LossyImageCompression"])
 MONOCHROME1 = "MONOCHROME1"
+PIXEL_DATA_TAG = 0x7FE00010
+
+
+def read_dicom_and_pixel(dicom_path: str) -> Tuple[FileDataset, np.ndarray]:
+    """
+    Reads a dicom file and the pixels to save as PNG. Large elements such as
+    the pixel data are deferred, so uncompressed pixels can be memory-mapped
+    from the file rather than read into memory
+    """
+    with open(dicom_path, "rb") as fp:
+        dicom = pydicom.dcmread(fp, defer_size="1 KB")
+        pixel_array = _map_uncompressed_pixel_array(dicom, fp)
+
+    if pixel_array is None:
+        # Other pixel data is read from the file on access, and compressed
+        # pixel data is decoded by pydicom's pixel data handlers
+        return dicom, get_dicom_pixel(dicom)
+
+    return dicom, _shift_and_invert_pixel(dicom, pixel_array)
+
+
+def get_dicom_pixel(dicom: FileDataset) -> np.ndarray:
+
+    pixel_dtype = get_uncompressed_pixel_dtype(dicom)
+    if pixel_dtype is None:
+        pixel_array = dicom.pixel_array
+    else:
+        # Uncompressed pixels can be viewed as an array as they are, without
+        # going through pydicom's pixel data handlers
+        pixel_array = np.frombuffer(
+            dicom.PixelData,
+            dtype=pixel_dtype,
+            count=dicom.Rows * dicom.Columns,
+        ).reshape(dicom.Rows, dicom.Columns)
 
+    return _shift_and_invert_pixel(dicom, pixel_array)
 
-def get_dicom_pixel(dicom_path: str) -> np.ndarray:
 
-    dicom = pydicom.dcmread(dicom_path)
-    pixel_array = dicom.pixel_array
+def _shift_and_invert_pixel(
+    dicom: FileDataset, pixel_array: np.ndarray
+) -> np.ndarray:
 
     # if the # bit/pixel is not a multiple of 8, we need to scale the pixel
     bits_stored = dicom["BitsStored"].value
     bits_allocated = dicom["BitsAllocated"].value
-    if bits_stored != bits_allocated:
-        pixel_array = pixel_array << (bits_allocated - bits_stored)
+    bit_shift = bits_allocated - bits_stored
 
     # x-ray images are grayscale with two types of Photometric Interpretation
     # values MONOCHROME1 and MONOCHROME2, we invert the pixel values in
     # MONOCHROME1 when creating PNG, and will invert it back when recovering
-    # the DICOM
-    if dicom["PhotometricInterpretation"].value.upper() == MONOCHROME1:
-        pixel_array = np.invert(pixel_array)
+    # the DICOM. Unsigned pixels are inverted around the largest stored value,
+    # so the padding bits above BitsStored are not flipped along with the
+    # pixel. That value does not fit signed pixels, which are inverted bitwise
+    # and then viewed as unsigned, so that the PNG keeps their bits
+    #
+    # Both steps write into a single output array, so an image is copied
+    # once, with no intermediate array per step
+    is_monochrome1 = (
+        dicom["PhotometricInterpretation"].value.upper() == MONOCHROME1
+    )
+    if is_monochrome1 and dicom.get("PixelRepresentation") == 1:
+        pixel_array = np.left_shift(pixel_array, bit_shift)
+        np.invert(pixel_array, out=pixel_array)
+        pixel_array = pixel_array.view(f"u{pixel_array.dtype.itemsize}")
+    elif is_monochrome1:
+        max_stored_value = (1 << bits_stored) - 1
+        pixel_array = np.subtract(
+            max_stored_value, pixel_array, dtype=pixel_array.dtype
+        )
+        if bit_shift != 0:
+            np.left_shift(pixel_array, bit_shift, out=pixel_array)
+    elif bit_shift != 0:
+        pixel_array = np.left_shift(pixel_array, bit_shift)
 
     return pixel_array
 
 
+def get_uncompressed_pixel_dtype(dicom: FileDataset) -> Optional[np.dtype]:
+    """
+    Returns the dtype of the stored pixels if they are a single frame of
+    uncompressed, unsigned, little endian grayscale values, and None otherwise
+    """
+    transfer_syntax = dicom.file_meta.get("TransferSyntaxUID")
+    if transfer_syntax is None or transfer_syntax.is_compressed:
+        return None
+    if not dicom.is_little_endian:
+        return None
+
+    samples_per_pixel = dicom.get("SamplesPerPixel") or 1
+    number_of_frames = dicom.get("NumberOfFrames") or 1
+    if samples_per_pixel != 1 or int(number_of_frames) != 1:
+        return None
+
+    bits_allocated = dicom.get("BitsAllocated")
+    if bits_allocated not in (8, 16) or dicom.get("PixelRepresentation") != 0:
+        return None
+
+    return np.dtype(f"<u{bits_allocated // 8}")
+
+
+def _map_uncompressed_pixel_array(
+    dicom: FileDataset, fp: BinaryIO
+) -> Optional[np.ndarray]:
+    """
+    Maps the pixel data of a dicom read from fp with deferred reading from
+    the file, if it can be viewed as an array as it is. Returns None otherwise
+    """
+    pixel_dtype = get_uncompressed_pixel_dtype(dicom)
+    if pixel_dtype is None or dicom.file_meta.TransferSyntaxUID.is_deflated:
+        # The elements of a deflated dicom are not where they are in the file
+        return None
+
+    # Dataset.get_item would read a deferred element, so look for the raw
+    # element among the values instead. The Pixel Data is usually the last
+    pixel_data = next(
+        (
+            element
+            for element in reversed(dicom.values())
+            if element.tag == PIXEL_DATA_TAG
+        ),
+        None,
+    )
+    # Only a deferred element still has its value in the file
+    if not isinstance(pixel_data, RawDataElement):
+        return None
+    if pixel_data.value is not None:
+        return None
+
+    pixel_count = dicom.Rows * dicom.Columns
+    if (
+        pixel_data.length == 0xFFFFFFFF
+        or pixel_data.length < pixel_count * pixel_dtype.itemsize
+    ):
+        return None
+
+    try:
+        pixel_map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    # The array keeps the map open, and the map stays valid after the file
+    # is closed
+    return np.frombuffer(
+        pixel_map,
+        dtype=pixel_dtype,
+        count=pixel_count,
+        offset=pixel_data.value_tell,
+    ).reshape(dicom.Rows, dicom.Columns)
+
+
 def extract_anonymized_metadata(
-    dicom_path: str, anonymized_identifiers: PatientIdentifiers
+    dicom: FileDataset, anonymized_identifiers: PatientIdentifiers
 ) -> dict:
 
-    # Read dicom file
-    dicom = pydicom.dcmread(dicom_path)
-
     anon_metadata = {}
 
     # Step 1: Extract file header metadata (different from the main dicom tags)
@@ -85,7 +244,7 @@ def extract_anonymized_metadata(
     )
 
     # Step 3: Add dummy identifiers for things like StudyID, PatientName
-    anon_metadata["minimal"].update(anonymized_identifiers.__dict__)
+    anon_metadata["minimal"].update(anonymized_identifiers)
 
     anon_metadata["all"] = {
         **anon_metadata["minimal"],
@@ -97,15 +256,35 @@ def extract_anonymized_metadata(
     return anon_metadata
 
 
+def get_anonymized_metadata_fieldnames() -> List[str]:
+    """
+    Lists every key that the "all" metadata returned by
+    extract_anonymized_metadata can have, in the same order
+    """
+    fieldnames = [
+        *_load_keywords(MINIMAL_TAGS_CSV_PATH),
+        *PatientIdentifiers.__annotations__,
+        *_load_keywords(ADDITIONAL_TAGS_CSV_PATH),
+        *SPECIAL_METADATA_KEYWORDS,
+        *HEADER_METADATA_KEYWORDS,
+    ]
+
+    # The actual image data is never extracted
+    return [
+        keyword
+        for keyword in dict.fromkeys(fieldnames)
+        if keyword != "PixelData"
+    ]
+
+
 def get_anonymized_dicom_from_dicom(
-    dicom_path: str, anonymized_identifiers: PatientIdentifiers
+    dicom: FileDataset, anonymized_identifiers: PatientIdentifiers
 ) -> FileDataset:
 
-    # Read dicom file
-    dicom = pydicom.dcmread(dicom_path)
-
-    # Step 1: Extract image
-    pixel_data = dicom.PixelData
+    # Step 1: Extract image. Take the Pixel Data element itself (still raw if
+    # its value was never accessed) rather than its value, so that the pixel
+    # bytes are moved to the new dicom without being converted or copied
+    pixel_data = dicom.get_item(PIXEL_DATA_TAG)
 
     # Step 2: Extract dicom header metadata
     filemeta, is_implicit_VR, is_little_endian = extract_dicom_header_metadata(
@@ -117,7 +296,7 @@ def get_anonymized_dicom_from_dicom(
     minimal_metadata = extract_metadata_from_dicom(
         dicom, MINIMAL_TAGS_CSV_PATH
     )
-    minimal_metadata.update(anonymized_identifiers.__dict__)
+    minimal_metadata.update(anonymized_identifiers)
 
     # Step 4: Generate dicom using minimal metadata
     anonymized_dicom = create_new_dicom(
@@ -137,11 +316,17 @@ def get_anonymized_dicom_from_metadata_png(
     # We shift and invert the pixel array for certain DICOMs when
     # generating the PNGs, so when we recover the DICOMs back, we
     # will need to undo the inverting and shifting
-    if metadata["PhotometricInterpretation"] == MONOCHROME1:
-        pixel_array = np.invert(pixel_array)
+    bits_stored = int(metadata["BitsStored"])
+    bit_unshift = int(metadata["BitsAllocated"]) - bits_stored
+    is_monochrome1 = metadata["PhotometricInterpretation"] == MONOCHROME1
+    if is_monochrome1 and int(metadata.get("PixelRepresentation", 0)) == 1:
+        pixel_array = np.invert(pixel_array) >> bit_unshift
+    else:
+        pixel_array = pixel_array >> bit_unshift
+        if is_monochrome1:
+            max_stored_value = (1 << bits_stored) - 1
+            pixel_array = max_stored_value - pixel_array
 
-    bit_unshift = metadata["BitsAllocated"] - metadata["BitsStored"]
-    pixel_array = pixel_array >> bit_unshift
     pixel_data = pixel_array.tobytes()
 
     is_implicit_VR = metadata["is_implicit_VR"]
@@ -158,7 +343,7 @@ def get_anonymized_dicom_from_metadata_png(
         StudyID=metadata["StudyID"],
         SOPInstanceUID=metadata["SOPInstanceUID"],
     )
-    minimal_metadata.update(anonymized_identifiers.__dict__)
+    minimal_metadata.update(anonymized_identifiers)
 
     filemeta = dict(
         [(keyword, metadata[keyword]) for keyword in FILEMETA_KEYWORDS]
@@ -178,7 +363,7 @@ def get_anonymized_dicom_from_metadata_png(
 
 
 def create_new_dicom(
-    pixel_data: bytes,
+    pixel_data: Union[bytes, DataElement, RawDataElement],
     dicom_entries: dict,
     file_meta: dict,
     is_implicit_VR: bool,
@@ -207,29 +392,17 @@ def create_new_dicom(
 
     # Step 3: Set all dicom metadata entries
     for keyword, value in dicom_entries.items():
-        if keyword in [
-            "PixelSpacing",
-            "PixelAspectRatio",
-            "ImagerPixelSpacing",
-            "WindowCenter",
-            "WindowWidth",
-        ]:
-            if type(value) == str:
-                value = ast.literal_eval(value)
-        if keyword in [
-            "CollimatorRightVerticalEdge",
-            "CollimatorUpperHorizontalEdge",
-            "CollimatorLowerHorizontalEdge",
-            "LargestImagePixelValue",
-            "SmallestImagePixelValue",
-        ]:
+        if keyword in INT_KEYWORDS:
             value = int(value)
-        if keyword in ["LossyImageCompression"]:
+        elif keyword in STR_KEYWORDS:
             value = str(value)
         ds.setdefault(keyword, value)
 
     # Step 4: Set the pixel data
-    ds.PixelData = pixel_data
+    if isinstance(pixel_data, bytes):
+        ds.PixelData = pixel_data
+    else:
+        ds[PIXEL_DATA_TAG] = pixel_data
 
     return ds
 
@@ -246,14 +419,13 @@ def get_anonymized_identifiers(
             - Series Instance UID
                 - SOP Instance UI
     """
+    anon_study_uid = f"{anon_patient_id}-{anon_study_id}"
     anonymized_identifiers = PatientIdentifiers(
         PatientID=f"{anon_patient_id}",
         PatientName=f"{anon_patient_id}",
-        StudyInstanceUID=f"{anon_patient_id}-{anon_study_id}",
-        StudyID=f"{anon_patient_id}-{anon_study_id}",
-        SOPInstanceUID=f"{anon_patient_id}-"
-        + f"{anon_study_id}-"
-        + f"{anon_file_id}",
+        StudyInstanceUID=anon_study_uid,
+        StudyID=anon_study_uid,
+        SOPInstanceUID=f"{anon_study_uid}-{anon_file_id}",
     )
 
     return anonymized_identifiers
@@ -286,6 +458,27 @@ def validate_keywords(keywords):
     assert len(invalid_keywords) == 0, f"Invalid keywords {invalid_keywords}"
 
 
+@functools.lru_cache(maxsize=None)
+def _load_keywords(tags_csv_path: str) -> Tuple[str, ...]:
+    """Reads and validates the keywords of a tags csv once per csv"""
+
+    with open(tags_csv_path, newline="") as tags_csv:
+        keywords = tuple(row["Keyword"] for row in csv.DictReader(tags_csv))
+    validate_keywords(keywords)
+
+    return keywords
+
+
+@functools.lru_cache(maxsize=None)
+def _load_keyword_tags(tags_csv_path: str) -> Tuple[Tuple[str, int], ...]:
+    """Pairs each keyword of a tags csv with its tag, resolved once per csv"""
+
+    return tuple(
+        (keyword, pydicom.datadict.tag_for_keyword(keyword))
+        for keyword in _load_keywords(tags_csv_path)
+    )
+
+
 def extract_metadata_from_dicom(
     dicom: Union[FileDataset, DicomDir], tags_csv_path: str
 ) -> dict:
@@ -294,19 +487,20 @@ def extract_metadata_from_dicom(
     by the user
     """
 
-    elements_to_extract = pd.read_csv(tags_csv_path)["Keyword"].tolist()
-    validate_keywords(elements_to_extract)
+    elements_to_extract = _load_keyword_tags(tags_csv_path)
 
     extracted_metadata = {}
 
-    for keyword in elements_to_extract:
+    for keyword, tag in elements_to_extract:
         if keyword == "PixelData":
             # Do not extract the actual image data
             continue
 
-        # Check that the element to extract exists in the dicom
-        if keyword in dicom.dir():
-            current_value = dicom[keyword].value
+        # Check that the element to extract exists in the dicom. Look it up
+        # by tag, since dicom.dir() rebuilds the list of all keywords
+        element = dicom.get(tag)
+        if element is not None:
+            current_value = element.value
             if type(current_value) == pydicom.multival.MultiValue:
                 current_value = list(current_value)
             extracted_metadata[keyword] = current_value
@@ -316,14 +510,17 @@ def extract_metadata_from_dicom(
 
 def extract_metadata_from_dict(meta_data: dict, tags_csv_path: str) -> dict:
 
-    elements_to_extract = pd.read_csv(tags_csv_path)["Keyword"].tolist()
-    validate_keywords(elements_to_extract)
+    elements_to_extract = _load_keywords(tags_csv_path)
 
     extracted_metadata = {}
 
     for keyword in elements_to_extract:
         if keyword in meta_data:
-            extracted_metadata[keyword] = meta_data[keyword]
+            value = meta_data[keyword]
+            # Parse values like "[0.1, 0.1]" once here, as read from the CSV
+            if keyword in LITERAL_KEYWORDS and type(value) == str:
+                value = ast.literal_eval(value)
+            extracted_metadata[keyword] = value
 
     return extracted_metadata
 
@@ -333,8 +530,7 @@ def extract_special_metadata(
 ) -> dict:
     """Extract metadata that needs modification to not be PHI"""
 
-    elements_to_modify = pd.read_csv(tags_csv_path)["Keyword"].tolist()
-    validate_keywords(elements_to_modify)
+    elements_to_modify = _load_keywords(tags_csv_path)
 
     private_keywords_in_dicom = [
         "PatientAge",
@@ -1,5 +1,7 @@
 # Standard library
-import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import csv
 import logging
 import os
 from pathlib import Path
@@ -10,6 +12,7 @@ import re
 # Third-party
 import cv2
 import pandas as pd
+import pydicom
 from tqdm import tqdm
 
 # First-party/Local
@@ -22,21 +25,28 @@ from .helpers import (
 )
 from .constants import (
     MAX_PATIENT_INDEX,
-    MAX_STUDY_INDEX 
+    MAX_STUDY_INDEX,
+    PROCESS_POOL_CHUNKSIZE,
 )
 
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b"DICM"
+PATIENT_FOLDER_PATTERN = re.compile(r"^patient_([1-9][0-9]*)$")
+STUDY_FOLDER_PATTERN = re.compile(r"^study_([1-9][0-9]*)$")
+
+
 def deidentify_dicoms(input_data_dir: Path) -> None:
     output_image_dir = utils.get_output_image_directory(input_data_dir)
 
     # Create the image output folder
     os.makedirs(output_image_dir, exist_ok=True)
-    
-    # Create a CSV file to record all the extracted metadata from the dicom
-    output_metadata_filename = utils.get_output_metadata_path(input_data_dir)
-    generate_anonymized_metadata(input_data_dir, output_metadata_filename)
 
-    # Convert DICOM files to PNG files
-    generate_png(input_data_dir, output_image_dir)
+    # Record all the extracted metadata from the dicom in a CSV file and
+    # convert DICOM files to PNG files, reading each DICOM file only once
+    output_metadata_filename = utils.get_output_metadata_path(input_data_dir)
+    generate_anonymized_metadata_and_png(
+        input_data_dir, output_metadata_filename, output_image_dir
+    )
 
     print("\n\n------------")
     print(ConsoleColoredTag.SUCCESS)
@@ -49,53 +59,106 @@ def deidentify_dicoms(input_data_dir: Path) -> None:
     )
 
 
-def generate_anonymized_metadata(input_data_dir: Path, output_metadata_filename: str) -> None:
+def generate_anonymized_metadata_and_png(
+    input_data_dir: Path, output_metadata_filename: str, new_image_dir: Path
+) -> None:
 
     print(
         f"{ConsoleTextColor.PURPLE}"
-        + "Start extracting anonymized metadata"
+        + "Start extracting anonymized metadata and converting DICOM to PNG"
         + f"{ConsoleTextColor.END}"
     )
 
     dicom_files = get_list_of_all_dicom_files(input_data_dir)
 
-    anon_metadata_all = []
+    # Write the metadata of each dicom to the CSV as soon as it is extracted,
+    # instead of holding the metadata of all dicoms in memory. Not every
+    # dicom has every tag, so the columns that no dicom has are only known
+    # at the end
+    fieldnames = deidentify_helper.get_anonymized_metadata_fieldnames()
+    fieldnames.append("filename")
+    extracted_fieldnames = set()
 
     # Do not show progress bar when logging level is low
     tqdm_disabled = logging.getLogger().level < logging.WARNING
-    for dicom_file in tqdm(dicom_files, disable=tqdm_disabled):
-        anonymized_identifiers = deidentify_helper.get_anonymized_identifiers(
-            dicom_file.patient_folder,
-            dicom_file.study_folder,
-            dicom_file.anon_dicom_id,
+    with open(output_metadata_filename, "w", newline="") as metadata_file, \
+            ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                initializer=_init_worker,
+                initargs=(logging.getLogger().level,),
+            ) as executor:
+        writer = csv.DictWriter(
+            metadata_file,
+            fieldnames=fieldnames,
+            extrasaction="ignore",
+            lineterminator="\n",
         )
-        anon_metadata = deidentify_helper.extract_anonymized_metadata(
-            dicom_file.path, anonymized_identifiers
+        writer.writeheader()
+
+        for anon_metadata in tqdm(
+            executor.map(
+                partial(_process_metadata_and_png, new_image_dir=new_image_dir),
+                dicom_files,
+                chunksize=PROCESS_POOL_CHUNKSIZE,
+            ),
+            total=len(dicom_files),
+            disable=tqdm_disabled,
+        ):
+            writer.writerow(anon_metadata)
+            extracted_fieldnames.update(anon_metadata)
+
+    # Only keep the columns of the tags found in at least one dicom
+    extracted_fieldnames = [
+        fieldname for fieldname in fieldnames
+        if fieldname in extracted_fieldnames
+    ]
+    if len(extracted_fieldnames) < len(fieldnames):
+        _rewrite_csv_columns(output_metadata_filename, extracted_fieldnames)
+
+
+def _rewrite_csv_columns(csv_path: Path, fieldnames: List[str]) -> None:
+    """Rewrites a CSV with only the given columns, one row at a time"""
+    rewritten_csv_path = f"{csv_path}.tmp"
+    with open(csv_path, newline="") as csv_file, \
+            open(rewritten_csv_path, "w", newline="") as rewritten_csv_file:
+        writer = csv.DictWriter(
+            rewritten_csv_file,
+            fieldnames=fieldnames,
+            extrasaction="ignore",
+            lineterminator="\n",
         )
+        writer.writeheader()
+        writer.writerows(csv.DictReader(csv_file))
+    os.replace(rewritten_csv_path, csv_path)
 
-        anon_metadata["all"]["filename"] = utils.get_dicom_filename(dicom_file)
-        anon_metadata_all.append(anon_metadata["all"])
 
-    anon_metadata_df = pd.DataFrame.from_records(anon_metadata_all)
-    anon_metadata_df.to_csv(output_metadata_filename, index=False)
+def _init_worker(log_level: int) -> None:
+    # Worker processes that are spawned rather than forked do not inherit the
+    # logging level set on the root logger of the main process
+    logging.getLogger().setLevel(log_level)
 
 
-def generate_png(input_data_dir: Path, new_image_dir: Path) -> None:
+def _process_metadata_and_png(
+    dicom_file: DicomFileInfo, new_image_dir: Path
+) -> dict:
+    dicom, pixel_array = deidentify_helper.read_dicom_and_pixel(
+        dicom_file.path
+    )
 
-    print(
-        f"{ConsoleTextColor.PURPLE}"
-        + "Start converting DICOM to PNG"
-        + f"{ConsoleTextColor.END}"
+    anonymized_identifiers = deidentify_helper.get_anonymized_identifiers(
+        dicom_file.patient_folder,
+        dicom_file.study_folder,
+        dicom_file.anon_dicom_id,
     )
+    anon_metadata = deidentify_helper.extract_anonymized_metadata(
+        dicom, anonymized_identifiers
+    )
+    anon_metadata["all"]["filename"] = utils.get_dicom_filename(dicom_file)
 
-    dicom_files = get_list_of_all_dicom_files(input_data_dir)
+    png_path = utils.get_png_path(new_image_dir, dicom_file)
+    utils.save_png(pixel_array, png_path)
 
-    # Do not show progress bar when logging level is low
-    tqdm_disabled = logging.getLogger().level < logging.WARNING
-    for dicom_file in tqdm(dicom_files, disable=tqdm_disabled):
-        pixel_array = deidentify_helper.get_dicom_pixel(dicom_file.path)
-        png_path = utils.get_png_path(new_image_dir, dicom_file)
-        utils.save_png(pixel_array, png_path)
+    return anon_metadata["all"]
 
 
 def generate_anonymized_dicom_from_dicom(
@@ -112,18 +175,39 @@ def generate_anonymized_dicom_from_dicom(
 
     # Do not show progress bar when logging level is low
     tqdm_disabled = logging.getLogger().level < logging.WARNING
-    for dicom_file in tqdm(dicom_files, disable=tqdm_disabled):
-        anonymized_identifiers = deidentify_helper.get_anonymized_identifiers(
-            dicom_file.patient_folder,
-            dicom_file.study_folder,
-            dicom_file.anon_dicom_id,
-        )
-        anon_dicom = deidentify_helper.get_anonymized_dicom_from_dicom(
-            dicom_file.path, anonymized_identifiers
-        )
+    with ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        initializer=_init_worker,
+        initargs=(logging.getLogger().level,),
+    ) as executor:
+        for _ in tqdm(
+            executor.map(
+                partial(_process_dicom, new_image_dir=new_image_dir),
+                dicom_files,
+                chunksize=PROCESS_POOL_CHUNKSIZE,
+            ),
+            total=len(dicom_files),
+            disable=tqdm_disabled,
+        ):
+            pass
+
+
+def _process_dicom(dicom_file: DicomFileInfo, new_image_dir: Path) -> None:
+    # The pixel data is only copied over to the new dicom, so defer reading
+    # large elements until they are accessed instead of parsing them upfront
+    dicom = pydicom.dcmread(dicom_file.path, defer_size="1 KB")
+
+    anonymized_identifiers = deidentify_helper.get_anonymized_identifiers(
+        dicom_file.patient_folder,
+        dicom_file.study_folder,
+        dicom_file.anon_dicom_id,
+    )
+    anon_dicom = deidentify_helper.get_anonymized_dicom_from_dicom(
+        dicom, anonymized_identifiers
+    )
 
-        dicom_path = utils.get_dicom_path(new_image_dir, dicom_file)
-        utils.save_dicom(anon_dicom, dicom_path)
+    dicom_path = utils.get_dicom_path(new_image_dir, dicom_file)
+    utils.save_dicom(anon_dicom, dicom_path)
 
 
 def generate_anonymized_dicom_from_metadata_png(
@@ -138,6 +222,9 @@ def generate_anonymized_dicom_from_metadata_png(
 
     generated_metadata_df = pd.read_csv(metadata_path)
 
+    # Scan the PNG folder once rather than once per metadata row
+    png_paths_by_filename = utils.get_png_paths_by_filename(png_dir)
+
     # Do not show progress bar when logging level is low
     tqdm_disabled = logging.getLogger().level < logging.WARNING
     for i in tqdm(range(len(generated_metadata_df)), disable=tqdm_disabled):
@@ -145,7 +232,7 @@ def generate_anonymized_dicom_from_metadata_png(
 
         file_name = meta_data["filename"]
 
-        generated_png_path = glob.glob(f"{png_dir}/*{file_name}.png")
+        generated_png_path = png_paths_by_filename.get(file_name, [])
         if len(generated_png_path) == 0:
             logging.warn(f"Corresponding PNG for {file_name} not found. Skip.")
             continue
@@ -175,70 +262,99 @@ def get_list_of_all_dicom_files(data_dir: Path) -> List[DicomFileInfo]:
     """
     all_dicom_files = []
 
-    # Iterate patient folders
-    patient_folders = os.listdir(data_dir)
-    for patient_folder in patient_folders:
-        patient_dir = Path(data_dir) / patient_folder
-        if not patient_dir.is_dir():
-            continue
+    # Iterate patient folders. os.scandir entries already know whether they
+    # are directories, so this avoids a stat call for every entry
+    with os.scandir(data_dir) as patient_entries:
+        for patient_entry in patient_entries:
+            if not patient_entry.is_dir():
+                continue
 
-        # check naming
-        patient_folder_pattern = re.compile(r'^patient_[1-9][0-9]*$')
-        if not patient_folder_pattern.match(patient_folder) \
-            or (int(re.findall(r"\d+", patient_folder)[0]) > MAX_PATIENT_INDEX):
-            logging.warning(
-                f"SKIPPING unknown patient folder {patient_folder}"
+            # check naming
+            patient_folder = patient_entry.name
+            patient_folder_match = PATIENT_FOLDER_PATTERN.match(patient_folder)
+            if patient_folder_match is None \
+                or (int(patient_folder_match.group(1)) > MAX_PATIENT_INDEX):
+                logging.warning(
+                    f"SKIPPING unknown patient folder {patient_folder}"
+                )
+                continue
+
+            all_dicom_files.extend(
+                _get_list_of_patient_dicom_files(patient_entry.path)
             )
-            continue
-        
-        # Iterate study folders within a patient folder
-        study_folders = os.listdir(patient_dir)
-        for study_folder in study_folders:
-            study_dir = Path(data_dir) / patient_folder / study_folder
-            if not study_dir.is_dir():
+
+    print(
+        f"{ConsoleColoredTag.INFO} Number of dicom files found: "
+        + f"{ConsoleTextColor.YELLOW}{len(all_dicom_files)}{ConsoleTextColor.END}"  # noqa: E501
+    )
+
+    return all_dicom_files
+
+
+def _get_list_of_patient_dicom_files(patient_dir: str) -> List[DicomFileInfo]:
+    patient_folder = os.path.basename(patient_dir)
+    patient_dicom_files = []
+
+    # Iterate study folders within a patient folder
+    with os.scandir(patient_dir) as study_entries:
+        for study_entry in study_entries:
+            if not study_entry.is_dir():
                 continue
 
             # check naming
-            study_folder_pattern = re.compile(r'^study_[1-9][0-9]*$') 
-            if not study_folder_pattern.match(study_folder) \
-                or (int(re.findall(r"\d+", study_folder)[0]) > MAX_STUDY_INDEX):
+            study_folder = study_entry.name
+            study_folder_match = STUDY_FOLDER_PATTERN.match(study_folder)
+            if study_folder_match is None \
+                or (int(study_folder_match.group(1)) > MAX_STUDY_INDEX):
                 logging.warning(
                     f"SKIPPING unknown study folder {study_folder}"
                 )
                 continue
 
             # Iterate dicom files within a study folder
-            dicom_filenames = os.listdir(study_dir)
-            for anon_dicom_id, dicom_filename in enumerate(dicom_filenames):
-                dicom_path = (
-                    Path(data_dir) / patient_folder / study_folder / dicom_filename
-                )
-
-                # Check the file type is DICOM
-                # Please do not remove this file type check because pydicom doesn't
-                # check file type before reading it as DICOM, which will likely throw an
-                # error about empty pixel data
-                file_type = magic.from_file(str(dicom_path))
-                if ("DICOM" in file_type) is False:
-                    logging.warning(
-                        f"SKIPPING {dicom_filename} because it is a "
-                        + f"{file_type} file"
+            with os.scandir(study_entry.path) as dicom_entries:
+                for anon_dicom_id, dicom_entry in enumerate(dicom_entries):
+                    dicom_filename = dicom_entry.name
+                    dicom_path = dicom_entry.path
+
+                    # Check the file type is DICOM
+                    # Please do not remove this file type check because pydicom
+                    # doesn't check file type before reading it as DICOM, which
+                    # will likely throw an error about empty pixel data
+                    if not _has_dicom_prefix(dicom_path):
+                        # Fall back to libmagic for files without the preamble
+                        file_type = magic.from_file(dicom_path)
+                        if ("DICOM" in file_type) is False:
+                            logging.warning(
+                                f"SKIPPING {dicom_filename} because it is a "
+                                + f"{file_type} file"
+                            )
+                            continue
+
+                    dicom_file_info = DicomFileInfo(
+                        path=dicom_path,
+                        patient_folder=patient_folder,
+                        study_folder=study_folder,
+                        anon_dicom_id=anon_dicom_id,
+                        filename=dicom_filename,
+                        png_name=utils.generate_png_name_from_dicom_filename(
+                            dicom_filename
+                        ),
                     )
-                    continue
-
-                dicom_file_info = DicomFileInfo(
-                    path=dicom_path,
-                    patient_folder=patient_folder,
-                    study_folder=study_folder,
-                    anon_dicom_id=anon_dicom_id,
-                    filename=dicom_filename,
-                )
 
-                all_dicom_files.append(dicom_file_info)
+                    patient_dicom_files.append(dicom_file_info)
 
-    print(
-        f"{ConsoleColoredTag.INFO} Number of dicom files found: "
-        + f"{ConsoleTextColor.YELLOW}{len(all_dicom_files)}{ConsoleTextColor.END}"  # noqa: E501
-    )
+    return patient_dicom_files
 
-    return all_dicom_files
+
+def _has_dicom_prefix(path: str) -> bool:
+    """
+    Checks for the "DICM" prefix that follows the 128-byte preamble of a
+    DICOM file, which is much cheaper than running libmagic on every file
+    """
+    try:
+        with open(path, "rb") as f:
+            f.seek(DICOM_PREAMBLE_LENGTH)
+            return f.read(len(DICOM_PREFIX)) == DICOM_PREFIX
+    except OSError:
+        return False
@@ -1,9 +1,12 @@
 # Standard library
+from io import BytesIO
 from pathlib import Path
+from typing import Dict, List
 import numpy as np
 import hashlib
 
 # Third-party
+import cv2
 from PIL import Image
 from pydicom.dataset import FileDataset
 
@@ -13,6 +16,7 @@ from ..constants import (
     NEW_DATA_DIR_NAME,
     NEW_IMAGE_DIR_NAME,
     OUTPUT_CSV_FILE_NAME,
+    PNG_COMPRESS_LEVEL,
 )
 from ..classes import DicomFileInfo
 
@@ -38,13 +42,17 @@ def generate_png_name(filename: str) -> str:
     return filename
 
 
-def get_dicom_filename(dicom_file: DicomFileInfo) -> str:
-    filename = dicom_file.filename
-    filename = filename[: filename.find(".dcm")]
+def generate_png_name_from_dicom_filename(dicom_filename: str) -> str:
+    filename = dicom_filename[: dicom_filename.find(".dcm")]
     filename = generate_png_name(filename)
     return filename
 
 
+def get_dicom_filename(dicom_file: DicomFileInfo) -> str:
+    # Hashed once when the dicom file is found, see DicomFileInfo.png_name
+    return dicom_file.png_name
+
+
 def get_png_path(new_image_dir: Path, dicom_file: DicomFileInfo) -> Path:
     filename = get_dicom_filename(dicom_file)
     patient_folder = dicom_file.patient_folder
@@ -56,6 +64,20 @@ def get_png_path(new_image_dir: Path, dicom_file: DicomFileInfo) -> Path:
     return png_path
 
 
+def get_png_paths_by_filename(png_dir: Path) -> Dict[str, List[str]]:
+    """Maps the filename part of each PNG created by get_png_path to its paths"""
+    png_paths_by_filename = {}
+    for png_path in Path(png_dir).iterdir():
+        if png_path.suffix != ".png":
+            continue
+
+        # PNG names are {patient_folder}-{study_folder}-{filename}.png
+        filename = png_path.stem.split("-", 2)[-1]
+        png_paths_by_filename.setdefault(filename, []).append(str(png_path))
+
+    return png_paths_by_filename
+
+
 def get_dicom_path(new_image_dir: Path, dicom_file: DicomFileInfo) -> Path:
     filename = get_dicom_filename(dicom_file)
     patient_folder = dicom_file.patient_folder
@@ -76,12 +98,36 @@ def get_dicom_path_from_png(png_path: str) -> str:
 
 
 def save_png(pixel_array: np.ndarray, save_path: Path) -> None:
-    im = Image.fromarray(pixel_array)
-    im.save(save_path, format="png")  # Do not use JPG!
+    if pixel_array.dtype not in (np.uint8, np.uint16):
+        # OpenCV would silently saturate any other dtype, such as the int16
+        # pixels of signed dicoms, to 8 bits
+        im = Image.fromarray(pixel_array)
+        im.save(save_path, format="png")  # Do not use JPG!
+        return
+
+    if pixel_array.ndim == 3:
+        # pydicom returns color pixels as RGB, while OpenCV writes BGR
+        pixel_array = cv2.cvtColor(pixel_array, cv2.COLOR_RGB2BGR)
+
+    # OpenCV hands the (often 16-bit) array straight to libpng, which is
+    # faster than PIL's 16-bit PNG path. Do not use JPG!
+    is_saved = cv2.imwrite(
+        str(save_path),
+        pixel_array,
+        [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESS_LEVEL],
+    )
+    if not is_saved:
+        raise OSError(f"Could not save PNG to {save_path}")
 
 
 def save_dicom(dicom_img: FileDataset, save_path: Path) -> None:
-    dicom_img.save_as(save_path, write_like_original=False)
+    # Encode the whole dicom in memory first, so that it is written to disk
+    # in one go rather than in many small writes, one per element
+    buffer = BytesIO()
+    dicom_img.save_as(buffer, write_like_original=False)
+    with open(save_path, "wb") as f:
+        # Write the buffer's memory as it is, without copying it to bytes
+        f.write(buffer.getbuffer())
 
 
 class ConsoleTextColor:
@@ -1,14 +1,20 @@
 # Standard library
-import glob
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+import hashlib
 import os
+import re
 import shutil
-import unittest
-from pathlib import Path
 
 # Third-party
 import cv2
 import numpy as np
 import pydicom
+import pytest
+from PIL import Image
+from pydicom.data import get_testdata_file
+from pydicom.pixel_data_handlers.util import pixel_dtype
 
 # First-party/Local
 from ..process import deidentify_dicoms
@@ -17,94 +23,442 @@ from ..process.helpers import utils
 from ..process.constants import GENERATED_DICOM_POSTFIX
 
 
-TEST_DATA_PATH = "dicom_extraction/test/example_data_package"
+# Relative to this file, so that the tests can be run from any directory
+TEST_DATA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "example_data_package"
+)
 
-class TestDicomDeidentification(unittest.TestCase):
-    def setUp(self):
-        self.test_data_path = Path(TEST_DATA_PATH)
+# Dicom files are read through a large buffer, so that pydicom's many small
+# reads of the element headers do not each become a system call
+DICOM_READ_BUFFER_SIZE = 1 << 16
 
-    def test_deidentified_image_quality(self):
-        # Clean up test output
-        expected_output_path = utils.get_output_root_directory(
-            self.test_data_path)
-        if os.path.exists(expected_output_path):
-            shutil.rmtree(expected_output_path)
+# Size in bytes of the digests the pixels are compared by
+PIXEL_DIGEST_SIZE = 16
 
-        # De-identify DICOM
-        deidentify_dicoms(self.test_data_path)
+PixelDigest = namedtuple("PixelDigest", ["path", "shape", "dtype", "digest"])
 
-        # Check output has been generated
-        self.assertTrue(os.path.exists(expected_output_path))
+# pydicom's own samples of pixel data that the example data does not have
+PYDICOM_PIXEL_SAMPLES = {
+    "rle": "MR_small_RLE.dcm",
+    "deflated": "image_dfl.dcm",
+    "signed": "CT_small.dcm",
+}
+
+# Elements that describe the pixels, compared before the pixels themselves
+PIXEL_METADATA_KEYWORDS = [
+    "Rows",
+    "Columns",
+    "BitsStored",
+    "PhotometricInterpretation",
+]
+
+# Generated files are named {patient_folder}-{study_folder}-{study}{postfix}
+GENERATED_DICOM_NAME_PATTERN = re.compile(
+    rf"^[^-]+-[^-]+-(?P<study>.+){re.escape(GENERATED_DICOM_POSTFIX)}$"
+)
+GENERATED_PNG_NAME_PATTERN = re.compile(r"^[^-]+-[^-]+-(?P<study>.+)\.png$")
+
+
+def iter_files(directory, suffix, depth=0):
+    """
+    Yields the os.DirEntry of every file ending with the suffix that is
+    depth folders below the directory, like
+    glob.glob(f"{directory}/{'*/' * depth}*{suffix}")
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            # glob does not match hidden files and folders either
+            if entry.name.startswith("."):
+                continue
+            if depth == 0:
+                if entry.name.endswith(suffix) and entry.is_file():
+                    yield entry
+            elif entry.is_dir():
+                yield from iter_files(entry.path, suffix, depth - 1)
+
+
+def can_view_pixels(dicom):
+    """
+    Whether the pixels are a single frame of uncompressed grayscale values,
+    which pydicom's numpy handler only views with their dtype
+    """
+    return (
+        not dicom.file_meta.TransferSyntaxUID.is_compressed
+        and (dicom.get("SamplesPerPixel") or 1) == 1
+        and int(dicom.get("NumberOfFrames") or 1) == 1
+        and dicom.BitsAllocated in (8, 16, 32)
+    )
+
+
+def read_dicom_pixels(path):
+    """
+    Reads the pixel array of a dicom file. Elements larger than 1 KB, such
+    as the pixel data, are only read from the file once they are accessed
+    """
+    with open(path, "rb", buffering=DICOM_READ_BUFFER_SIZE) as fp:
+        dicom = pydicom.dcmread(fp, defer_size="1 KB")
+        # Decode with pydicom rather than the tool's own helpers, so that the
+        # reference pixels do not depend on the code under test
+        if can_view_pixels(dicom):
+            # View uncompressed pixels with the dtype pydicom decodes them
+            # to, without going through its pixel data handlers
+            pixel_array = np.frombuffer(
+                dicom.PixelData,
+                dtype=pixel_dtype(dicom),
+                count=dicom.Rows * dicom.Columns,
+            ).reshape(dicom.Rows, dicom.Columns)
+        else:
+            pixel_array = dicom.pixel_array
+    return pixel_array
 
-        expected_image_output_path = utils.get_output_image_directory(
-            self.test_data_path
-        )
-        self.assertTrue(os.path.exists(expected_image_output_path))
 
-        generated_metadata_path = utils.get_output_metadata_path(
-            self.test_data_path
+def read_dicom_pixel_digest(path):
+    """
+    Reads the pixel array of a dicom file and summarizes it by its shape,
+    dtype and a digest of its values, so that the pixels can be compared
+    without sending the whole array back from a worker process
+    """
+    pixel_array = read_dicom_pixels(path)
+    digest = hashlib.blake2b(
+        np.ascontiguousarray(pixel_array), digest_size=PIXEL_DIGEST_SIZE
+    ).digest()
+    return PixelDigest(path, pixel_array.shape, pixel_array.dtype, digest)
+
+
+def read_dicoms_pixel_digests(paths):
+    """
+    Reads the pixel digests of the dicom files in parallel, in the same
+    order as the paths
+    """
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(
+            executor.map(read_dicom_pixel_digest, paths, chunksize=4)
         )
-        self.assertTrue(os.path.exists(generated_metadata_path))
 
-        # Construct DICOM(s) from the generated PNGs and metadata
-        deidentify_process.generate_anonymized_dicom_from_metadata_png(
-            generated_metadata_path, expected_image_output_path
+
+def read_pngs(paths):
+    """
+    Reads the PNG files in parallel, in the same order as the paths. OpenCV
+    releases the GIL while decoding, so threads are enough
+    """
+    read_png = partial(cv2.imread, flags=cv2.IMREAD_UNCHANGED)
+    with ThreadPoolExecutor() as executor:
+        return list(executor.map(read_png, paths))
+
+
+def get_generated_dicoms(expected_image_output_path):
+    generated_dicoms = {}
+    generated_dicom_entries = list(
+        iter_files(expected_image_output_path, ".dcm")
+    )
+    generated_dicom_paths = [entry.path for entry in generated_dicom_entries]
+    for entry, pixel_digest in zip(
+        generated_dicom_entries,
+        read_dicoms_pixel_digests(generated_dicom_paths),
+    ):
+        # Extract filename
+        study = GENERATED_DICOM_NAME_PATTERN.match(entry.name)["study"]
+        generated_dicoms[study] = pixel_digest
+    return generated_dicoms
+
+
+def get_generated_pngs(expected_image_output_path):
+    generated_png_entries = list(
+        iter_files(expected_image_output_path, ".png")
+    )
+    generated_png_paths = [entry.path for entry in generated_png_entries]
+    generated_pngs = {}
+    for entry, png in zip(
+        generated_png_entries, read_pngs(generated_png_paths)
+    ):
+        # Extract filename
+        study = GENERATED_PNG_NAME_PATTERN.match(entry.name)["study"]
+        generated_pngs[study] = png
+    return generated_pngs
+
+
+@lru_cache(maxsize=None)
+def get_original_dicom_paths(input_path):
+    """
+    Lists the original DICOM(s) of a test data path once, for every helper
+    that needs them. A tuple is returned so that the cached value can not be
+    modified by a caller
+    """
+    return tuple(
+        entry.path for entry in iter_files(input_path, ".dcm", depth=2)
+    )
+
+
+@lru_cache(maxsize=None)
+def get_original_dicoms(input_path):
+    """
+    The original DICOM(s) never change, so they are only read once per test
+    data path and shared by every test
+    """
+    original_dicom_paths = get_original_dicom_paths(input_path)
+    original_dicoms = {}
+    for path, pixel_digest in zip(
+        original_dicom_paths, read_dicoms_pixel_digests(original_dicom_paths)
+    ):
+        study = os.path.basename(path).rpartition(".dcm")[0]
+        original_dicoms[study] = pixel_digest
+    return original_dicoms
+
+
+def read_dicom_metadata(path):
+    """
+    Reads only the elements describing the pixels of a dicom file, which is
+    much cheaper than reading and decoding the pixels themselves
+    """
+    with open(path, "rb", buffering=DICOM_READ_BUFFER_SIZE) as fp:
+        dicom = pydicom.dcmread(
+            fp, specific_tags=PIXEL_METADATA_KEYWORDS, stop_before_pixels=True
         )
-        generated_dicoms = self.get_generated_dicoms(
-            expected_image_output_path
+    return {keyword: dicom.get(keyword) for keyword in PIXEL_METADATA_KEYWORDS}
+
+
+def get_generated_dicoms_metadata(expected_image_output_path):
+    generated_dicoms_metadata = {}
+    for entry in iter_files(expected_image_output_path, ".dcm"):
+        # Extract filename
+        study = GENERATED_DICOM_NAME_PATTERN.match(entry.name)["study"]
+        generated_dicoms_metadata[study] = read_dicom_metadata(entry.path)
+    return generated_dicoms_metadata
+
+
+@lru_cache(maxsize=None)
+def get_original_dicoms_metadata(input_path):
+    """
+    Like get_original_dicoms, the metadata of the original DICOM(s) is only
+    read once per test data path
+    """
+    original_dicoms_metadata = {}
+    for path in get_original_dicom_paths(input_path):
+        study = os.path.basename(path).rpartition(".dcm")[0]
+        original_dicoms_metadata[study] = read_dicom_metadata(path)
+    return original_dicoms_metadata
+
+
+def get_original_studies(input_path):
+    return [
+        os.path.basename(path).rpartition(".dcm")[0]
+        for path in get_original_dicom_paths(input_path)
+    ]
+
+
+@pytest.fixture(scope="session")
+def example_data_path(tmp_path_factory):
+    """
+    Copies the example data to a temporary folder once for the whole
+    session. The output is written next to its input, so this keeps it out
+    of the source tree and apart from other test sessions
+    """
+    example_data_path = (
+        tmp_path_factory.mktemp("deidentification") / "example_data_package"
+    )
+    shutil.copytree(TEST_DATA_PATH, example_data_path)
+    return example_data_path
+
+
+@pytest.fixture(scope="session")
+def deidentified(example_data_path):
+    """
+    De-identifies the test data and constructs DICOM(s) from the generated
+    PNGs and metadata once for the whole session, so that every test can
+    check the output without running the pipeline again. Returns the image
+    output directory
+    """
+    # De-identify DICOM
+    deidentify_dicoms(example_data_path)
+
+    # Construct DICOM(s) from the generated PNGs and metadata
+    expected_image_output_path = utils.get_output_image_directory(
+        example_data_path
+    )
+    deidentify_process.generate_anonymized_dicom_from_metadata_png(
+        utils.get_output_metadata_path(example_data_path),
+        expected_image_output_path,
+    )
+    return expected_image_output_path
+
+
+def pair_by_study(originals, generated):
+    """
+    Pairs every original with the one generated from it by study, so that
+    the generated name of each study is only computed once per session
+    """
+    return {
+        study: (original, generated.get(utils.generate_png_name(study)))
+        for study, original in originals.items()
+    }
+
+
+@pytest.fixture(scope="session")
+def pixel_metadata_pairs(deidentified):
+    return pair_by_study(
+        get_original_dicoms_metadata(TEST_DATA_PATH),
+        get_generated_dicoms_metadata(deidentified),
+    )
+
+
+@pytest.fixture(scope="session")
+def pixel_pairs(deidentified):
+    return pair_by_study(
+        get_original_dicoms(TEST_DATA_PATH),
+        get_generated_dicoms(deidentified),
+    )
+
+
+def test_output_generated(example_data_path, deidentified):
+    # The image folder and the metadata are both directly in the output
+    # folder, so one scan covers both
+    expected_output_path = utils.get_output_root_directory(example_data_path)
+    with os.scandir(expected_output_path) as entries:
+        output_names = {entry.name for entry in entries}
+    generated_metadata_path = utils.get_output_metadata_path(example_data_path)
+    assert deidentified.name in output_names
+    assert generated_metadata_path.name in output_names
+
+
+@pytest.mark.parametrize("study", get_original_studies(TEST_DATA_PATH))
+def test_pixel_metadata_equality(pixel_metadata_pairs, study):
+    # Compare the pixel metadata of the generated dicom and the original
+    # dicom first. A broken de-identification usually changes these, and they
+    # can be checked without decoding pixels
+    original_metadata, generated_metadata = pixel_metadata_pairs[study]
+    assert generated_metadata == original_metadata
+
+
+def assert_pixels_equal(original_pixels, generated_pixels):
+    assert generated_pixels is not None
+    # Check shape and dtype on their own first, so that a mismatch is
+    # reported as such rather than as unequal pixels
+    assert generated_pixels.shape == original_pixels.shape
+    assert generated_pixels.dtype == original_pixels.dtype
+    if generated_pixels.digest != original_pixels.digest:
+        # Only read the pixels again when they differ, to report where
+        np.testing.assert_array_equal(
+            read_dicom_pixels(generated_pixels.path),
+            read_dicom_pixels(original_pixels.path),
         )
 
-        # Get the original DICOM(s)
-        input_path = self.test_data_path
-        original_dicoms = self.get_original_dicoms(input_path)
-
-        try:
-            # Compare the pixels of the generated dicom and the original dicom
-            assert np.all(
-                [
-                    np.all(
-                        generated_dicoms[
-                            utils.generate_png_name(study)
-                        ].pixel_array
-                        == original_dicoms[study].pixel_array
-                    )
-                    for study in original_dicoms.keys()
-                ]
-            )
-        finally:
-            shutil.rmtree(expected_output_path)
-
-    def get_generated_dicoms(self, expected_image_output_path):
-        generated_dicoms = {}
-        generated_dicom_paths = glob.glob(
-            f"{expected_image_output_path}/*.dcm"
+
+@pytest.mark.parametrize("study", get_original_studies(TEST_DATA_PATH))
+def test_pixel_equality(pixel_pairs, study):
+    # Compare the pixels of the generated dicom and the original dicom
+    assert_pixels_equal(*pixel_pairs[study])
+
+
+@pytest.fixture(scope="session")
+def pixel_pairs_from_dicom(tmp_path_factory):
+    """
+    De-identifies a copy of the test data, along with pydicom's samples of
+    pixel data it does not have, straight from DICOM to DICOM once for the
+    whole session
+    """
+    test_data_path = (
+        tmp_path_factory.mktemp("dicom_to_dicom") / "example_data_package"
+    )
+    shutil.copytree(TEST_DATA_PATH, test_data_path)
+    sample_study_path = test_data_path / "patient_3" / "study_1"
+    sample_study_path.mkdir(parents=True)
+    for study, sample in PYDICOM_PIXEL_SAMPLES.items():
+        shutil.copy(
+            get_testdata_file(sample), sample_study_path / f"{study}.dcm"
         )
-        for path in generated_dicom_paths:
-            # Extract filename
-            study = "-".join(path.split("-")[2:])
-            study = study[: study.find(GENERATED_DICOM_POSTFIX)]
-            generated_dicoms[study] = pydicom.dcmread(path)
-        return generated_dicoms
-
-    def get_generated_pngs(self, expected_image_output_path):
-        generated_png_paths = glob.glob(f"{expected_image_output_path}/*.png")
-        generated_pngs = {}
-        for path in generated_png_paths:
-            # Extract filename
-            study = "-".join(path.split("-")[2:])
-            study = study[: study.find(".png")]
-            generated_pngs[study] = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-        return generated_pngs
-
-    def get_original_dicoms(self, input_path):
-        original_dicom_paths = glob.glob(f"{input_path}/*/*/*.dcm")
-        original_dicoms = {}
-        for path in original_dicom_paths:
-            study = path[: path.find(".dcm")]
-            study = os.path.split(study)[1]
-            original_dicoms[study] = pydicom.dcmread(path)
-        return original_dicoms
-
-
-if __name__ == "__main__":
-    unittest.main()
+
+    expected_image_output_path = utils.get_output_image_directory(
+        test_data_path
+    )
+    os.makedirs(expected_image_output_path)
+    deidentify_process.generate_anonymized_dicom_from_dicom(
+        test_data_path, expected_image_output_path
+    )
+    return pair_by_study(
+        get_original_dicoms(str(test_data_path)),
+        get_generated_dicoms(expected_image_output_path),
+    )
+
+
+@pytest.mark.parametrize(
+    "study",
+    [*get_original_studies(TEST_DATA_PATH), *PYDICOM_PIXEL_SAMPLES],
+)
+def test_pixel_equality_from_dicom(pixel_pairs_from_dicom, study):
+    # The pixel data is moved to the new dicom as it is, whether or not it
+    # is compressed
+    assert_pixels_equal(*pixel_pairs_from_dicom[study])
+
+
+def round_trip_study(test_data_path):
+    """
+    De-identifies the single study of a test data path and constructs a DICOM
+    from the generated PNG and metadata. Returns the pixels of the PNG and
+    of the constructed DICOM
+    """
+    deidentify_dicoms(test_data_path)
+    expected_image_output_path = utils.get_output_image_directory(
+        test_data_path
+    )
+    deidentify_process.generate_anonymized_dicom_from_metadata_png(
+        utils.get_output_metadata_path(test_data_path),
+        expected_image_output_path,
+    )
+
+    [generated_png] = get_generated_pngs(expected_image_output_path).values()
+    [generated_dicom_entry] = iter_files(expected_image_output_path, ".dcm")
+    return generated_png, read_dicom_pixels(generated_dicom_entry.path)
+
+
+def test_signed_dicom_round_trip(tmp_path):
+    # The example data is all unsigned, so check a signed dicom, whose
+    # pixels are int16 rather than uint8 or uint16, on its own
+    test_data_path = tmp_path / "signed_data"
+    study_path = test_data_path / "patient_1" / "study_1"
+    study_path.mkdir(parents=True)
+    original_dicom_path = shutil.copy(
+        get_testdata_file("CT_small.dcm"), study_path / "signed.dcm"
+    )
+    original_pixels = read_dicom_pixels(original_dicom_path)
+    assert original_pixels.dtype == np.int16
+
+    generated_png, generated_pixels = round_trip_study(test_data_path)
+
+    # The PNG keeps every value of the pixels
+    np.testing.assert_array_equal(generated_png, original_pixels)
+    np.testing.assert_array_equal(generated_pixels, original_pixels)
+
+
+def test_signed_monochrome1_dicom_round_trip(tmp_path):
+    # Signed MONOCHROME1 pixels can not be inverted around their largest
+    # stored value like unsigned ones, as it does not fit their dtype
+    test_data_path = tmp_path / "signed_data"
+    study_path = test_data_path / "patient_1" / "study_1"
+    study_path.mkdir(parents=True)
+    dicom = pydicom.dcmread(get_testdata_file("CT_small.dcm"))
+    dicom.PhotometricInterpretation = "MONOCHROME1"
+    original_dicom_path = study_path / "signed.dcm"
+    dicom.save_as(original_dicom_path)
+    original_pixels = read_dicom_pixels(original_dicom_path)
+    assert original_pixels.dtype == np.int16
+
+    generated_png, generated_pixels = round_trip_study(test_data_path)
+
+    # The PNG keeps every value of the pixels, inverted
+    np.testing.assert_array_equal(
+        generated_png,
+        np.iinfo(np.uint16).max - original_pixels.astype(np.uint16),
+    )
+    np.testing.assert_array_equal(generated_pixels, original_pixels)
+
+
+def test_save_color_png(tmp_path):
+    # Color pixels are RGB, as pydicom returns them
+    pixel_array = np.zeros((4, 3, 3), dtype=np.uint8)
+    pixel_array[..., 0] = 200
+    png_path = tmp_path / "color.png"
+    utils.save_png(pixel_array, png_path)
+
+    with Image.open(png_path) as png:
+        assert png.mode == "RGB"
+        np.testing.assert_array_equal(np.asarray(png), pixel_array)